@@ -1,4 +1,4 @@
-# Microglia Quantification v9.2
+# Microglia Quantification v10
 #
 # This ImageJ script measures microglia in images. 
 #
@@ -13,12 +13,14 @@
 #  - Maximal Intensity Projection from Z dimension.
 #  - Find nuclei using channel 1.
 #  - Find microglia using channel 2 and verify that there is a nucleus.
-#  - Measures microglia area, perimeter, RI, cable-length. 
+#  - Measures microglia area, perimeter, RI, skeleton length. 
 #    - Area [um^2] of cell (after Maximum Intensity Projection)
 #    - Perimeter [um] - the 2D length of the memebrane of the cell
 #    - RI = (perimeter/area)/[2(π/area)^(1/2)]
-#    - Cable-length is the sum of lengths of a cell's skeleton ramifocations.
-#  - Export to excel file in the folder.
+#    - Skeleton_Length [um] is the number of skeleton pixels in the cell times the pixel width, over all 
+#      skeleton fragments in the cell. Diagonal steps count as 1 pixel, so it is up to ~29% shorter than 
+#      the SNT cable-length (path length of the largest tree) of v9 and earlier.
+#  - Export to a csv file per image, and all images to one excel file in the folder.
 #
 # Installation:
 #  - Copy membrane.ilp to "C:\Users\myusername\microglia\" , where "myusername" is your user name.
@@ -28,9 +30,9 @@
 #  - ResultsToExcel (for Read and Write Excel)
 #  - Neuroanatomy (for SNT)
 #  - ROIs to Masks
-#  - CLIJ and CLIJ2
-#  - ilastik (and "Configure ilastik executable location")
-#  - Masks from ROIs
+#  - CLIJ, CLIJ2 and clijx-assistant (CLIJx)
+#  - ilastik (set the executable with Plugins > ilastik > Configure ilastik executable location, 
+#    otherwise ILASTIK_EXECUTABLE below is used)
 #
 # Changes in v2: 
 #  - Fixed cable_length in excel.
@@ -47,17 +49,40 @@
 # Changes in v8: 
 #  - Added Ilastik membrane mask to segment ramifications
 #  - Added MICROGLIA_MAX_SIZE
+# Changes in v10:
+#  - Cable_Length (SNT) is replaced by Skeleton_Length, computed for all cells in one pass on the GPU 
+#    (CLIJx skeletonize). The values are not comparable to v9, so results are saved in analysis_v10.
+#  - MIP is computed while reading the file, without loading the whole Z-stack.
+#  - ilastik is run once on all images of the folder, and only for images that were not already segmented.
+#  - Nuclei are segmented on the GPU (top-hat background subtraction and Otsu threshold).
+#  - The next image is read while the current image is processed.
+#  - One excel file for the folder instead of one per image, with a sheet per image and a sheet of all images.
+#  - Microglia ROIs are found from GPU label statistics instead of Analyze Particles.
 
 import os
+import subprocess
+from jarray import array, zeros
 from math import pi as PI, sqrt
-from ij import IJ, ImagePlus, Prefs
-from ij.process import ImageConverter
-from ij import WindowManager
+from java.io import IOException
+from java.util.concurrent import Callable, Executors
+from java.util.concurrent.atomic import AtomicBoolean
+from java.util.concurrent.locks import ReentrantLock
+from ij import IJ, ImagePlus, ImageStack, CompositeImage, Prefs
+from ij.process import ByteProcessor, ShortProcessor, Blitter
+from ij.plugin import RGBStackMerge
 from ij.plugin.frame import RoiManager
-from ij.measure import Measurements, ResultsTable
+from ij.measure import Calibration, Measurements, ResultsTable
+from loci.formats import ChannelSeparator, FormatException, FormatTools, MetadataTools
+from loci.formats.out import OMETiffWriter
+from loci.plugins.util import ImageProcessorReader, LociPrefs
+from ome.units import UNITS
 from sc.fiji.snt.analysis import SkeletonConverter, TreeAnalyzer, SNTTable
 from sc.fiji.snt import Tree
-from ij.gui import GenericDialog, WaitForUserDialog
+from ij.gui import GenericDialog, PolygonRoi, Roi, Wand, WaitForUserDialog
+from net.haesleinhuepf.clij.coremem.enums import NativeTypeEnum
+from net.haesleinhuepf.clijx import CLIJx
+from org.ilastik.ilastik4ij.ui import IlastikOptions
+from org.scijava.prefs import PrefService
 
 
 DEBUG = False
@@ -67,20 +92,28 @@ NUCLEUS_INTERSECTION_WITH_CELL = 15  # Minimum size of nucleus in cell [microns]
 MICROGLIA_MIN_SIZE = 20
 MICROGLIA_MIN_SIZE_3D = 10
 MICROGLIA_MAX_SIZE = 500
+CABLE_LENGTH_MIN_BOUNDS_AREA = 64  # ROIs with a smaller bounding box [pixels] get cable-length 0 without skeletonizing
+ILASTIK_EXECUTABLE = "C:\\Program Files\\ilastik-1.4.0\\ilastik.exe"  # Used if not configured in the ilastik plugin
+TILE_SIZE = 2048  # Size [pixels] of the XY tiles read from the file when projecting
 MEMBRANE_MODEL_FILE =  "~\\microglia\\membrane.ilp"  # ~ exapnds to the user's dicrectory, e.g.: C:\Users\myusername
+IMAGE_THREADS = 2  # Number of images read and processed at the same time
+IJ_LOCK = ReentrantLock(True)  # Guards the ROI Manager, Results and image windows, which are shared by all images
+STOP_PROCESSING = AtomicBoolean(False)  # Set when an image fails, so the images still in the pool are skipped
 
 
-def get_cable_length(roi, ip, imp):
+def get_cable_length(roi, ip, cal):
+    bounds = roi.getBounds()
+    if bounds.width * bounds.height < CABLE_LENGTH_MIN_BOUNDS_AREA:
+        return 0.0
     ip.setRoi(roi);
-    cal = imp.getCalibration()
     cropped = ImagePlus("cropped image", ip.crop())
     cropped.setCalibration(cal)
     # cropped.show()
     # IJ.showMessage("1111")
-    skelConv = SkeletonConverter(cropped, True)
     # Debug: IJ.log(str(cropped.getRawStatistics().max))
     cable_length = 0.0
     if cropped.getRawStatistics().max > 0:
+        skelConv = SkeletonConverter(cropped, True)
         #    IJ.log(str(skelConv))
         #    IJ.log(str(dir(skelConv)))
         trees = skelConv.getTrees()
@@ -99,13 +132,460 @@ def get_cable_length(roi, ip, imp):
     return cable_length
 
 
-def remove_inverted_lut():
-    imp = IJ.getImage()
-    ip = imp.getProcessor()
-    print "isInvertedLut", imp.isInvertedLut()
-    if imp.isInvertedLut():
-        print "inverting"
-        IJ.run(imp, "Invert LUT", "")
+def rois_to_label_image(rois, width, height):
+    # Label image where ROI i of the ROI Manager is painted with value i+1
+    sp = ShortProcessor(width, height)
+    for i, roi in enumerate(rois):
+        sp.setValue(i + 1)
+        sp.fill(roi)
+    return ImagePlus("labels", sp)
+
+
+def rois_to_mask(title, rois, width, height, calibration):
+    # Binary (0-255) mask of the ROIs
+    bp = ByteProcessor(width, height)
+    bp.setValue(255)
+    for roi in rois:
+        bp.fill(roi)
+    imp = ImagePlus(title, bp)
+    imp.setCalibration(calibration)
+    return imp
+
+
+def get_label_sums(clijx, image, labels):
+    # Sum of the pixels of image in every label, as a dict: label -> sum
+    stats = ResultsTable()
+    clijx.statisticsOfLabelledPixels(image, labels, stats)
+    sums = {}
+    for row in range(stats.size()):
+        sums[int(stats.getValue("IDENTIFIER", row))] = stats.getValue("SUM_INTENSITY", row)
+    return sums
+
+
+def segment_nuclei(clijx, imp_dapi):
+    # Nuclei mask on the GPU: background subtraction (top-hat, radius 30) and Otsu threshold.
+    # Returns a binary (0/1) buffer, which the caller releases.
+    dapi = clijx.push(imp_dapi)
+    background_subtracted = clijx.create(dapi)
+    clijx.topHatBox(dapi, background_subtracted, 30, 30, 0)
+    nuclei = clijx.create(dapi.getDimensions(), NativeTypeEnum.UnsignedByte)
+    clijx.thresholdOtsu(background_subtracted, nuclei)
+    for buffer in [dapi, background_subtracted]:
+        clijx.release(buffer)
+    return nuclei
+
+
+def get_nuclei_areas(clijx, nuclei, rois, calibration):
+    # Area [microns^2] of the binary nuclei buffer inside every ROI, computed for all ROIs in one pass on the GPU.
+    # ROIs are expected not to overlap (they are connected components of one mask).
+    labels = clijx.push(rois_to_label_image(rois, nuclei.getWidth(), nuclei.getHeight()))
+    nuclei_pixels = get_label_sums(clijx, nuclei, labels)
+    clijx.release(labels)
+    pixel_area = calibration.pixelWidth * calibration.pixelHeight
+    return [nuclei_pixels.get(i + 1, 0) * pixel_area for i in range(len(rois))]
+
+
+def get_skeleton_lengths(imp_mask, rois):
+    # Skeleton length [microns] of every ROI, from a single skeleton of the whole mask computed on the GPU.
+    # The length is the number of skeleton pixels in the ROI times the pixel width (diagonal steps count as 1).
+    clijx = CLIJx.getInstance()
+    mask = clijx.push(imp_mask)
+    binary = clijx.create(mask)
+    clijx.greaterConstant(mask, binary, 0)
+    skeleton = clijx.create(binary)
+    clijx.skeletonize(binary, skeleton)
+    labels = clijx.push(rois_to_label_image(rois, imp_mask.getWidth(), imp_mask.getHeight()))
+    skeleton_pixels = get_label_sums(clijx, skeleton, labels)
+    for buffer in [mask, binary, skeleton, labels]:
+        clijx.release(buffer)
+    pixel_width = imp_mask.getCalibration().pixelWidth
+    return [skeleton_pixels.get(i + 1, 0) * pixel_width for i in range(len(rois))]
+
+
+def open_mip(file_path):
+    # Maximum Intensity Projection of every channel, returned as one 2D ImagePlus per channel.
+    # The file is streamed one Z-plane tile at a time, so the full stack is never held in memory.
+    meta = MetadataTools.createOMEXMLMetadata()
+    reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+    reader.setMetadataStore(meta)
+    try:
+        reader.setId(file_path)
+        width = reader.getSizeX()
+        height = reader.getSizeY()
+        calibration = Calibration()
+        pixel_width = meta.getPixelsPhysicalSizeX(0)
+        pixel_height = meta.getPixelsPhysicalSizeY(0)
+        if pixel_width is not None and pixel_height is not None:
+            calibration.pixelWidth = pixel_width.value(UNITS.MICROMETER).doubleValue()
+            calibration.pixelHeight = pixel_height.value(UNITS.MICROMETER).doubleValue()
+            calibration.setUnit("micron")
+        channels = []
+        for c in range(reader.getSizeC()):
+            mip = None
+            for z in range(reader.getSizeZ()):
+                plane = reader.getIndex(z, c, 0)
+                for y in range(0, height, TILE_SIZE):
+                    for x in range(0, width, TILE_SIZE):
+                        tile = reader.openProcessors(plane, x, y, 
+                                                     min(TILE_SIZE, width - x), min(TILE_SIZE, height - y))[0]
+                        if mip is None:
+                            mip = tile.createProcessor(width, height)
+                        mip.copyBits(tile, x, y, Blitter.MAX)
+            imp = ImagePlus("C" + str(c + 1) + "-MIP", mip)
+            imp.setCalibration(calibration)
+            channels.append(imp)
+    finally:
+        reader.close()
+    return channels
+
+
+def make_composite(title, channels):
+    # Composite image of copies of the given 2D channel images
+    stack = ImageStack(channels[0].getWidth(), channels[0].getHeight())
+    for channel in channels:
+        stack.addSlice(channel.getProcessor().duplicate())
+    imp = ImagePlus(title, stack)
+    imp.setDimensions(len(channels), 1, 1)
+    imp.setCalibration(channels[0].getCalibration())
+    return CompositeImage(imp, CompositeImage.COLOR)
+
+
+def segmented_file_name(file_name):
+    # File name of the ilastik segmentation of an image, as named by run_pixel_classification().
+    # Keeps the extension, so x.nd2 and x.tif in the same folder don't share a segmentation.
+    return file_name + "_seg.tif"
+
+
+def is_segmentation_up_to_date(file_path, segmented_file, membrane_model_file):
+    # A segmentation from a previous run is reused if it is newer than both the image and the ilastik model
+    if not os.path.exists(segmented_file):
+        return False
+    return os.path.getmtime(segmented_file) > max(os.path.getmtime(file_path), 
+                                                   os.path.getmtime(membrane_model_file))
+
+
+def export_for_ilastik(file_path, ome_tif_path):
+    # Copy the first time point of an image to an OME-TIFF (XYCZT), one plane at a time, for ilastik.
+    # Returns the axes of the copy as read by ilastik, which drops axes of size 1, e.g. "zcyx".
+    reader = ChannelSeparator(LociPrefs.makeImageReader())
+    try:
+        reader.setId(file_path)
+        meta = MetadataTools.createOMEXMLMetadata()
+        MetadataTools.populateMetadata(meta, 0, None, reader.isLittleEndian(), "XYCZT", 
+                                       FormatTools.getPixelTypeString(reader.getPixelType()), 
+                                       reader.getSizeX(), reader.getSizeY(), reader.getSizeZ(), reader.getSizeC(), 1, 1)
+        writer = OMETiffWriter()
+        writer.setMetadataRetrieve(meta)
+        writer.setBigTiff(True)
+        writer.setId(ome_tif_path)
+        try:
+            for z in range(reader.getSizeZ()):
+                for c in range(reader.getSizeC()):
+                    writer.saveBytes(z * reader.getSizeC() + c, reader.openBytes(reader.getIndex(z, c, 0)))
+        finally:
+            writer.close()
+        return ("z" if reader.getSizeZ() > 1 else "") + ("c" if reader.getSizeC() > 1 else "") + "yx"
+    finally:
+        reader.close()
+
+
+def get_ilastik_executable():
+    # The ilastik executable configured in the ilastik plugin (ilastik4ij), or ILASTIK_EXECUTABLE if not configured
+    context = IJ.runPlugIn("org.scijava.Context", "")
+    ilastik = context.getService(PrefService).get(IlastikOptions, "executableFile")
+    if ilastik:
+        return ilastik
+    return os.path.expanduser(ILASTIK_EXECUTABLE)
+
+
+def run_pixel_classification(membrane_model_file, file_paths, output_dir):
+    # Segment all images with a single headless ilastik run, instead of starting ilastik once per image.
+    # The axes are passed explicitly, so images with different axes (e.g. a single Z-plane) get their own run.
+    # ilastik can't read .nd2 files, so the images are first copied to OME-TIFFs in output_dir/ilastik_input.
+    # The copies are deleted afterwards, and the segmentations are moved to output_dir.
+    ilastik = get_ilastik_executable()
+    assert os.path.exists(ilastik), ilastik
+    input_dir = os.path.join(output_dir, "ilastik_input")
+    if not os.path.exists(input_dir):
+        os.mkdir(input_dir)
+    try:
+        ome_tif_paths = []
+        input_paths_by_axes = {}
+        for file_path in file_paths:
+            # The extension is kept in the name (x.nd2 -> x_nd2.ome.tif), so x.nd2 and x.tif get different copies
+            ome_tif_path = os.path.join(input_dir, os.path.basename(file_path).replace(".", "_") + ".ome.tif")
+            axes = export_for_ilastik(file_path, ome_tif_path)
+            ome_tif_paths.append(ome_tif_path)
+            input_paths_by_axes.setdefault(axes, []).append(ome_tif_path)
+        for axes, input_paths in input_paths_by_axes.items():
+            print "Running ilastik on", len(input_paths), "images with axes", axes
+            subprocess.check_call([ilastik, "--headless", 
+                                   "--project=" + membrane_model_file, 
+                                   "--input_axes=" + axes, 
+                                   "--export_source=Simple Segmentation",  # 1 = backgound, 2 = foreground cell
+                                   "--output_format=multipage tiff", 
+                                   "--output_filename_format=" + os.path.join(input_dir, "{nickname}_seg.tif")] + 
+                                  input_paths)
+        for file_path, ome_tif_path in zip(file_paths, ome_tif_paths):
+            move_segmentation(ome_tif_path, os.path.join(output_dir, segmented_file_name(os.path.basename(file_path))))
+    finally:
+        for name in os.listdir(input_dir):
+            os.remove(os.path.join(input_dir, name))
+        os.rmdir(input_dir)
+
+
+def move_segmentation(ome_tif_path, segmented_file):
+    # Move ilastik's segmentation of ome_tif_path to segmented_file. 
+    # Depending on the ilastik version, the {nickname} of "name.ome.tif" is "name" or "name.ome".
+    nickname = ome_tif_path[:-len(".ome.tif")]
+    for seg_path in [nickname + "_seg.tif", nickname + ".ome_seg.tif"]:
+        if os.path.exists(seg_path):
+            if os.path.exists(segmented_file):
+                os.remove(segmented_file)
+            os.rename(seg_path, segmented_file)
+            return
+    raise IOError("ilastik did not segment " + ome_tif_path)
+
+
+def segment_microglia(clijx, segmented_file):
+    # 2D mask of the 3D microglia objects in the ilastik segmentation (1 = backgound, 2 = foreground cell).
+    # Returns a binary (0/1) buffer, which the caller releases.
+    segmented_3d = IJ.openImage(segmented_file)
+    IJ.setRawThreshold(segmented_3d, 2, 255);
+    IJ.run(segmented_3d, "Convert to Mask", "method=Default background=Dark ");
+    objects_3d = segmented_3d.duplicate()
+    objects_3d.setTitle("objects_3D")
+    IJ.run(objects_3d, "Invert", "stack")
+    IJ.run("3D OC Options", " redirect_to=none")
+    IJ.run(objects_3d, "3D Objects Counter on GPU (CLIJx, Experimental)", "cl_device=[Quadro M4000] threshold=254 slice=4 " + 
+            " min.=" + str(MICROGLIA_MIN_SIZE_3D) + " max.=9999999 objects");
+    # Mask of the MIP of the 3D objects, computed on the GPU
+    objects_map = IJ.getImage()  # opened by the 3D objects counter
+    objects = clijx.push(objects_map)
+    objects_map.close()
+    objects_2d = clijx.create(array([objects.getWidth(), objects.getHeight()], "l"), objects.getNativeType())
+    clijx.maximumZProjection(objects, objects_2d)
+    mask_2d = clijx.create(objects_2d.getDimensions(), NativeTypeEnum.UnsignedByte)
+    clijx.greaterConstant(objects_2d, mask_2d, 0.5)
+    for buffer in [objects, objects_2d]:
+        clijx.release(buffer)
+    return mask_2d
+
+
+def get_particle_rois(clijx, mask, calibration):
+    # ROIs of the connected components of a binary buffer, like Analyze Particles with "exclude": 
+    # area [microns^2] between MICROGLIA_MIN_SIZE and MICROGLIA_MAX_SIZE, not touching the image edges.
+    # The labels are pulled once, and every particle is traced with the 8-connected Wand, like Analyze Particles.
+    labels = clijx.create(mask.getDimensions(), NativeTypeEnum.Float)
+    clijx.connectedComponentsLabelingBox(mask, labels)
+    stats = ResultsTable()
+    clijx.statisticsOfLabelledPixels(mask, labels, stats)
+    label_ip = clijx.pull(labels).getProcessor()
+    clijx.release(labels)
+    pixel_area = calibration.pixelWidth * calibration.pixelHeight
+    rois = []
+    for row in range(stats.size()):
+        area = stats.getValue("PIXEL_COUNT", row) * pixel_area
+        if area < MICROGLIA_MIN_SIZE or area > MICROGLIA_MAX_SIZE:
+            continue
+        if (stats.getValue("BOUNDING_BOX_X", row) == 0 or stats.getValue("BOUNDING_BOX_Y", row) == 0 or 
+                stats.getValue("BOUNDING_BOX_END_X", row) >= mask.getWidth() - 1 or 
+                stats.getValue("BOUNDING_BOX_END_Y", row) >= mask.getHeight() - 1):
+            continue
+        # Trace the outline from the leftmost pixel of the top row of the particle, as Analyze Particles does
+        identifier = stats.getValue("IDENTIFIER", row)
+        y = int(stats.getValue("BOUNDING_BOX_Y", row))
+        x = int(stats.getValue("BOUNDING_BOX_X", row))
+        while label_ip.getf(x, y) != identifier:
+            x += 1
+        wand = Wand(label_ip)
+        wand.autoOutline(x, y, identifier, identifier, Wand.EIGHT_CONNECTED)
+        rois.append(PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI))
+    return rois
+
+
+def merge_csv_files(csv_files, merged_file):
+    # Concatenate Results CSV files that have the same columns, adding a "File" column with the source file name
+    merged = open(merged_file, "w")
+    try:
+        for i, csv_file in enumerate(csv_files):
+            f = open(csv_file)
+            try:
+                lines = f.readlines()
+            finally:
+                f.close()
+            if i == 0:
+                merged.write(lines[0].rstrip("\r\n") + ",File\n")
+            file_name = os.path.basename(csv_file)[:-len(".csv")]
+            if "," in file_name:  # quoted like labels in ResultsTable.saveAs
+                file_name = '"' + file_name + '"'
+            for line in lines[1:]:
+                merged.write(line.rstrip("\r\n") + "," + file_name + "\n")
+    finally:
+        merged.close()
+
+
+def excel_sheet_name(file_name, used_names):
+    # Excel sheet name of an image: at most 31 characters, without []:*?/\ , and not in used_names
+    base = "".join("_" if ch in "[]:*?/\\" else ch for ch in file_name)
+    used = [used_name.lower() for used_name in used_names + ["all_images"]]
+    name = base[:31]
+    i = 1
+    while name.lower() in used:
+        suffix = "_" + str(i)
+        name = base[:31 - len(suffix)] + suffix
+        i += 1
+    return name
+
+
+def process_image(rm, file_name, mip_channels, analysis_dir):
+    # Segment and measure the microglia of one image, given the MIP of its channels
+    rm.reset();  # Reset ROIs in Manager
+    calibration = mip_channels[1].getCalibration()
+    if DEBUG:
+        print("calibration", calibration)
+    
+    # MIP
+    mip = make_composite("MIP - " + file_name, mip_channels)  # images may reach the lock out of order
+    mip.show()
+    
+    # Nuceli
+    clijx = CLIJx.getInstance()
+    nuclei = segment_nuclei(clijx, mip_channels[0])  # stays on the GPU until nuclei are measured
+    imp_nuclei = clijx.pullBinary(nuclei)
+    imp_nuclei.setCalibration(calibration)
+    imp_nuclei.setTitle("nuclei")
+    imp_nuclei.show()
+
+    # Microglia segmentation
+    objects_2d = segment_microglia(clijx, os.path.join(analysis_dir, segmented_file_name(file_name)))
+    for roi in get_particle_rois(clijx, objects_2d, calibration):
+        rm.addRoi(roi)
+    clijx.release(objects_2d)
+
+    # Remove microglia ROIs that do not have a significant nucleus
+    rm.runCommand(imp_nuclei, "Show All with labels")
+    to_be_deleted = []
+    if DEBUG:
+        print rm.getCount()
+    if rm.getCount() > 0:
+        nuclei_areas = get_nuclei_areas(clijx, nuclei, rm.getRoisAsArray(), 
+                                        calibration)  # area of nucleus in cell calibrated
+        if DEBUG:
+            print "nuclei_areas", nuclei_areas
+        to_be_deleted = [i for i, area in enumerate(nuclei_areas) if area < NUCLEUS_INTERSECTION_WITH_CELL]
+        if DEBUG:
+            print "to_be_deleted", to_be_deleted
+        rm.setSelectedIndexes(to_be_deleted)
+        rm.runCommand("Delete");
+    clijx.release(nuclei)
+        
+    # User interaction
+    myWait = WaitForUserDialog("Microglia Segmentation", 
+                               file_name + ":\nYou can now edit the automatically detected segments and click OK.")
+    myWait.show()
+
+    # Measure Microglia ROIs
+    microglia_mask = rois_to_mask("microglia_mask", rm.getRoisAsArray(), 
+                                  mip.getWidth(), mip.getHeight(), calibration)
+    microglia_mask.show()
+    if rm.getCount() > 0:
+        # Measure microglia
+        IJ.run("Clear Results")
+        rm.runCommand(microglia_mask, "Measure");
+        # Add RI measure
+        results = ResultsTable.getResultsTable()
+        perimeter_column = results.getColumnIndex("Perim.")
+        area_column = results.getColumnIndex("Area")
+        if DEBUG:
+            print "results.size()", results.size()
+        ip = microglia_mask.getProcessor()
+        cal = microglia_mask.getCalibration()
+        skeleton_lengths = get_skeleton_lengths(microglia_mask, rm.getRoisAsArray())
+        assert results.size() == rm.getCount()  # to make sure that ROIs match results
+        perimeters = results.getColumnAsDoubles(perimeter_column)
+        areas = results.getColumnAsDoubles(area_column)  # ROI areas
+        ris = zeros(results.size(), "d")
+        log_lines = []  # written to the Log window once, after the loop
+        for row in range(results.size()):
+            ris[row] = perimeters[row] / (2 * sqrt(PI * areas[row]))  # == perimeter / area / (2 * sqrt(PI / area))
+            assert ris[row] >= 1, ris[row]  # Assert. Should never happen.
+            if DEBUG:
+                roi = rm.getRoi(row)
+                log_lines.append(str(row)+ " " + str(roi) + " skeleton length GPU " + str(skeleton_lengths[row]) + 
+                                 " cable length SNT " + str(get_cable_length(roi, ip, cal)))
+        if DEBUG:
+            IJ.log("\n".join(log_lines))
+        results.setValues("RI", ris)
+        results.setValues("Skeleton_Length", array(skeleton_lengths, "d"))
+        results.show("Results")
+        results.deleteColumn("%Area")
+        
+        # Save CSV
+        csv_file = os.path.join(analysis_dir, file_name + ".csv")
+        print "Saving csv_file " + csv_file
+        results.saveAs(csv_file);
+
+    # Save image with segmentation.
+    IJ.run(mip, "Make Composite", "");
+    mip.setC(1)  # set channel
+    IJ.run(mip, "Enhance Contrast", "saturated=0.35")
+    mip.setC(2)
+    IJ.run(mip, "Enhance Contrast", "saturated=0.35")
+    
+    IJ.run(mip, "Show Overlay", "");
+    mip_image_file = analysis_dir + "/" + file_name + ".tif"
+    print "Saving " + mip_image_file
+    IJ.save(mip, mip_image_file);
+    
+    masks = RGBStackMerge.mergeChannels(array([microglia_mask, None, imp_nuclei], ImagePlus), True)  # c1, c3
+    IJ.save(masks, analysis_dir + "/" + file_name + "_masks.png")
+    # return
+    IJ.run("Close All")  # close windows after processing each image
+    # end processing one image
+
+
+class ProcessImage(Callable):
+    # Task of the image thread pool. Reading the image runs in parallel to the processing of the previous 
+    # image, processing runs under IJ_LOCK since it relies on the ROI Manager and the active window.
+    def __init__(self, rm, file_path, file_name, analysis_dir):
+        self.rm = rm
+        self.file_path = file_path
+        self.file_name = file_name
+        self.analysis_dir = analysis_dir
+
+    def call(self):
+        # Returns False if the image could not be opened, or was skipped since another image failed
+        if STOP_PROCESSING.get():
+            return False
+        file_path = self.file_path
+        print "processing image: ", file_path
+        try:
+            mip_channels = open_mip(file_path)
+        except (IOException, FormatException), e:
+            STOP_PROCESSING.set(True)
+            IJ_LOCK.lock()
+            try:
+                print "Could not open image " + file_path, e
+                IJ.showMessage("Could not open image " + file_path)
+            finally:
+                IJ_LOCK.unlock()
+            return False
+        except:
+            STOP_PROCESSING.set(True)  # any other failure, e.g. OutOfMemoryError, also stops the other images
+            raise
+        IJ_LOCK.lock()
+        try:
+            if STOP_PROCESSING.get():
+                return False
+            try:
+                process_image(self.rm, self.file_name, mip_channels, self.analysis_dir)
+            except:
+                STOP_PROCESSING.set(True)
+                raise
+        finally:
+            IJ_LOCK.unlock()
+        return True
 
 
 def main():
@@ -118,227 +598,74 @@ def main():
     
     # Choose folder
     input_dir = IJ.getDirectory("Select a folder with images");
-    print "input_dir: ", input_dir
+    if DEBUG:
+        print "input_dir: ", input_dir
 
     # Loop images
     file_list = os.listdir(input_dir)
-    print file_list
-    print "Found ", len(file_list), "files"
-    analysis_dir = os.path.join(input_dir, "analysis_v9")
+    if DEBUG:
+        print file_list
+        print "Found ", len(file_list), "files"
+    analysis_dir = os.path.join(input_dir, "analysis_v10")
     if not os.path.exists(analysis_dir):
         os.mkdir(analysis_dir)  
+    image_files = [f for f in file_list if f.endswith((".nd2", ".tif"))]
+    image_paths = dict((f, os.path.join(input_dir, f)) for f in image_files)
+    print "Found ", len(image_files), "images"
     
-    for file_name in file_list:
-        file_path = os.path.join(input_dir, file_name); 
-        print("loop " + file_path);
-        if not (file_name.endswith(".nd2") or file_name.endswith(".tif")):
-          continue
-        
-        rm.reset();  # Reset ROIs in Manager
-        # Open image
-        print "processing image: ", file_path
-        IJ.run("Bio-Formats Importer", 
-               "open='" + file_path + 
-               "' autoscale color_mode=Default rois_import=[ROI manager] view=Hyperstack stack_order=XYCZT")
-        if WindowManager.getImageCount() == 0:
-            print "Could not open image " + file_path
-            IJ.showMessage("Could not open image " + file_path)
-            exit()
-        IJ.run("Z Project...", "projection=[Max Intensity]");
-        
-        # MIP
-        imp = IJ.getImage()
-        imp.setTitle("MIP");
+    # Segment microglia in all images with one ilastik run
+    membrane_model_file = os.path.expanduser(MEMBRANE_MODEL_FILE)
+    assert os.path.exists(membrane_model_file), membrane_model_file
+    to_segment = [f for f in image_files 
+                  if not is_segmentation_up_to_date(image_paths[f], 
+                                                    os.path.join(analysis_dir, segmented_file_name(f)), 
+                                                    membrane_model_file)]
+    if to_segment:
+        run_pixel_classification(membrane_model_file, 
+                                 [image_paths[f] for f in to_segment], analysis_dir)
+    
+    pool = Executors.newFixedThreadPool(IMAGE_THREADS)
+    futures = []
+    for file_name in image_files:
+        futures.append(pool.submit(ProcessImage(rm, image_paths[file_name], file_name, analysis_dir)))
+    pool.shutdown()
+    try:
+        for future in futures:
+            if not future.get():
+                exit()
+    finally:
+        pool.shutdownNow()  # cancels the images not started yet, if an image failed
+    
+    # Create folder Summary
+    csv_files = [os.path.join(analysis_dir, file_name + ".csv") for file_name in image_files]
+    csv_files = [csv_file for csv_file in csv_files if os.path.isfile(csv_file)]
+    if csv_files:
+        # "Read and Write Excel" adds to an existing file, so results of a previous run are removed first
+        parent_name = os.path.normpath(input_dir).split(os.path.sep)[-1]
+        folder_excel_file = os.path.join(analysis_dir, "summary_" + parent_name + ".xlsx")
+        if os.path.exists(folder_excel_file):
+            os.remove(folder_excel_file)
+        print "Saving folder results " + folder_excel_file
         
-        # Nuceli
-        IJ.run("Duplicate...", "duplicate channels=1");
-        imp = IJ.getImage()
-        imp.setTitle("nuclei")
-        IJ.run("Subtract Background...", "rolling=30")
-        IJ.setAutoThreshold(imp, "Otsu dark")
-        IJ.run(imp, "Convert to Mask", "")
-        remove_inverted_lut()
-
-        # Microglia segmentation
-        IJ.selectWindow("MIP")
-        IJ.run("Duplicate...", "duplicate channels=2-2")
-        imp = IJ.getImage()
-        imp.setTitle("antibody_raw")
-        calibration = imp.getCalibration()
-        print("calibration", calibration)
-        IJ.run("Enhance Contrast", "saturated=0.35")
-                
-        membrane_model_file = os.path.expanduser(MEMBRANE_MODEL_FILE)
-        assert os.path.exists(membrane_model_file), membrane_model_file
-        if not DEBUG:
-            IJ.run("Run Pixel Classification Prediction", 
-                        "projectfilename=[" + membrane_model_file + "] " + 
-                        " inputimage=[" + file_path + "] pixelclassificationtype=Segmentation")
-        else:
-            segmented_file = os.path.join(analysis_dir, file_name + "_seg.tif")
-            if os.path.exists(segmented_file):
-                IJ.open(segmented_file)
-            else:
-                IJ.run("Run Pixel Classification Prediction", 
-                        "projectfilename=" + membrane_model_file + " " + 
-                        " inputimage=[" + file_path + "] pixelclassificationtype=Segmentation")
-                IJ.save(segmented_file)
-        IJ.getImage().setTitle("segmented_3D")  # 1 = backgound, 2 = foreground cell
-        imp = IJ.getImage()
-        IJ.setRawThreshold(imp, 2, 255);
-        IJ.run(imp, "Convert to Mask", "method=Default background=Dark ");
-        IJ.run("Duplicate...", "duplicate")
-        IJ.getImage().setTitle("objects_3D")
-        IJ.run(IJ.getImage(), "Invert", "stack")
-        IJ.run("3D OC Options", " redirect_to=none")
-        IJ.run("3D Objects Counter on GPU (CLIJx, Experimental)", "cl_device=[Quadro M4000] threshold=254 slice=4 " + 
-                " min.=" + str(MICROGLIA_MIN_SIZE_3D) + " max.=9999999 objects");
-        IJ.run("Enhance Contrast", "saturated=0.35");
-        IJ.run("Z Project...", "projection=[Max Intensity]");
-        IJ.run(IJ.getImage(), "Fire", "");
-        ImageConverter.setDoScaling(False);
-        IJ.run("16-bit")
-        IJ.setRawThreshold(IJ.getImage(), 1, 65536)
-        IJ.run(IJ.getImage(), "Convert to Mask", "")
-        imp_objects_2d = IJ.getImage()
-        imp_objects_2d.setCalibration(calibration)
-        print("calibration", calibration)
-        IJ.run("Analyze Particles...", "size=" + 
-               str(MICROGLIA_MIN_SIZE) + "-" + str(MICROGLIA_MAX_SIZE) + " show=Masks exclude add slice")
-        IJ.getImage().setTitle("microglia_antibody_mask")
-        remove_inverted_lut()
-
-        # Remove microglia ROIs that do not have a significant nucleus
-        IJ.selectWindow("nuclei");
-        rm.runCommand("Show All with labels")
-        imp = IJ.getImage()
-        to_be_deleted = []
-        print rm.getCount()
-        if rm.getCount() > 0:
-            for i in range(rm.getCount()):
-                roi = rm.getRoi(i)
-                imp.setRoi(roi)
-                stats = imp.getAllStatistics();  # getStatistics returns are of ROI and not foreground area
-                if DEBUG:
-                    # print dir(stats)
-                    print "areaFraction", stats.areaFraction
-                sum_nuclei_gray = stats.area * stats.areaFraction / 100  # area of nucleus in cell calibrated
-                if DEBUG:
-                    print "sum_nuclei_gray", sum_nuclei_gray
-                if sum_nuclei_gray < NUCLEUS_INTERSECTION_WITH_CELL:
-                    to_be_deleted.append(i)
-            if DEBUG:
-                print "to_be_deleted", to_be_deleted
-            rm.setSelectedIndexes(to_be_deleted)
-            rm.runCommand("Delete");
-            
-        # User interaction
-        myWait = WaitForUserDialog("Microglia Segmentation", "You can now edit the automatically detected segments and click OK.")
-        myWait.show()
-
-        # Measure Microglia ROIs
-        IJ.selectWindow("microglia_antibody_mask")
-        if rm.getCount() > 0:
-            # Convert ROI manager to Mask
-            IJ.run("Select All")
-            IJ.run("Clear", "slice")
-            # Create new window with ROIs as mask:
-            IJ.run("Binary (0-255) mask(s) from Roi(s)", "show_mask(s) save_in=[] suffix=[] rm=[RoiManager[visible=true]]")
-        else:
-            IJ.run("Duplicate...", "duplicate ignore ")
-        imp = IJ.getImage()  # without this setTitle doesn't work
-        imp.setTitle("microglia_mask")
-        if rm.getCount() > 0:
-            # Measure microglia
-            IJ.selectWindow("microglia_mask")
-            IJ.run("Clear Results")
-            rm.runCommand("Measure");
-            # Add RI measure
-            results = ResultsTable.getResultsTable()
-            print "results.size()", results.size()
-            imp = IJ.getImage()
-            ip = imp.getProcessor()
-            for row in range(results.size()):
-                perimeter = results.getValue("Perim.", row)
-                area = results.getValue("Area", row)  # ROI area
-                ri = perimeter / area / (2 * sqrt((PI / area)))
-                assert ri >= 1, ri  # Assert. Should never happen.
-                results.setValue("RI", row, ri)
-                assert results.size() == rm.getCount()  # to make sure that ROIs match results
-                roi = rm.getRoi(row)
-                IJ.log(str(row)+ " " + str(roi));
-                cable_length = get_cable_length(roi, ip, imp)
-                results.setValue("Cable_Length", row, cable_length)
+        # One sheet per image, with the Summarize statistics of that image
+        sheet_names = []
+        for csv_file in csv_files:
+            results = ResultsTable.open(csv_file)
             results.show("Results")
-            results.deleteColumn("%Area")
-            
-            # Save CSV
-            csv_file = os.path.join(analysis_dir, file_name + ".csv")
-            print "Saving csv_file " + csv_file
-            IJ.saveAs("Results", csv_file);
-            
-            # Save excel
-            excel_file = os.path.join(analysis_dir, file_name + ".xlsx")
             IJ.run("Summarize");
-            print "Saving image results " + excel_file
-            IJ.run("Read and Write Excel", "file=[" + excel_file + "] dataset_label=[]")
-
-        # Save image with segmentation.
-        IJ.selectWindow("MIP");
-        IJ.run("Make Composite");
-        IJ.getImage().setC(1)  # set channel
-        IJ.run("Enhance Contrast", "saturated=0.35")
-        IJ.getImage().setC(2)
-        IJ.run("Enhance Contrast", "saturated=0.35")
-        
-        IJ.run("Show Overlay");
-        mip_image_file = analysis_dir + "/" + file_name + ".tif"
-        print "Saving " + mip_image_file
-        IJ.save(mip_image_file);
-        
-        IJ.selectWindow("microglia_mask")
-        IJ.run("Merge Channels...", "c1=microglia_mask c3=nuclei create keep")
-        IJ.save(analysis_dir + "/" + file_name + "_masks.png")
-        # return
-        IJ.run("Close All")  # close windows after processing each image
-        # end processing one image
-    
-    # Create folder Summary
-    IJ.run("Clear Results")
-    results = ResultsTable.getResultsTable()
-    for file_name in file_list:
-        if not (file_name.endswith(".nd2") or file_name.endswith(".tif")):
-          continue
-        file_path = os.path.join(input_dir, file_name) 
-        csv_file = os.path.join(analysis_dir, file_name + ".csv")
-        print csv_file
-        if not os.path.isfile(csv_file):
-          continue
-        IJ.open(csv_file)
-        csv_table = ResultsTable.getActiveTable()
-        print "heads", csv_table.headings
-        for row in range(csv_table.size()):
-            results.incrementCounter()
-            results.addLabel(str(csv_table.getLabel(row)))
-            for col in range(1, len(csv_table.headings)):
-                val = csv_table.getValue(csv_table.headings[col], row)
-                results.addValue(csv_table.headings[col], val)
-        IJ.selectWindow(csv_table.getTitle()); 
-        IJ.run("Close");
-    results.show("Results")
-    IJ.run("Summarize");
-    
-    # parent_name = os.path.normpath(input_dir).split(os.path.sep)[-1]
-    # print "parent_name", parent_name
-    # folder_excel_file = os.path.join(analysis_dir, "summary_"  + 
-    #     parent_name + ".csv")
-    # print "Saving folder results " + folder_excel_file
-    # if not os.path.exists(analysis_dir):
-    #         os.mkdir(analysis_dir)  
-    # IJ.saveAs("Results", folder_excel_file);    
-    # Theres is a bug in "Read and Write Excel" that doesn't export labels
-    # IJ.run("Read and Write Excel", "file=[" + folder_excel_file + "] dataset_label=[]")
+            sheet_name = excel_sheet_name(os.path.basename(csv_file)[:-len(".csv")], sheet_names)
+            sheet_names.append(sheet_name)
+            IJ.run("Read and Write Excel", "file=[" + folder_excel_file + "] sheet=[" + sheet_name + "] dataset_label=[]")
         
+        # All images in one sheet. The image of each row is in the File column, since 
+        # there is a bug in "Read and Write Excel" that doesn't export labels
+        summary_csv_file = os.path.join(analysis_dir, "summary.csv")
+        print "Saving folder results " + summary_csv_file
+        merge_csv_files(csv_files, summary_csv_file)
+        results = ResultsTable.open(summary_csv_file)
+        results.show("Results")
+        IJ.run("Summarize");
+        IJ.run("Read and Write Excel", "file=[" + folder_excel_file + "] sheet=[all_images] dataset_label=[]")
     
     print "Finished"
     IJ.showMessage("Finshed processing folder.")